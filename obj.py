@@ -1,9 +1,47 @@
-import zlib
 import hashlib
+import importlib.util
+import binascii
+import mmap
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from repository import *
 import collections
 
+# ISA-L is a faster drop-in for zlib, use it when it is installed
+try:
+    from isal import isal_zlib as _zlib
+except ImportError:
+    import zlib as _zlib
+
+# numba compiles the tree record scan to machine code when it is installed,
+# only look for it here since importing it is slow, tree_parse loads it lazily
+_HAVE_NUMBA = all(importlib.util.find_spec(m) is not None for m in ("numba", "numpy"))
+
+# same level git uses for loose objects, favours speed over ratio
+COMPRESSION_LEVEL = 1
+# size of the reads fed to the decompressor
+READ_CHUNK_SIZE = 1 << 16
+# longest "<type> <size>\x00" header object_read will inflate before giving up
+MAX_HEADER_SIZE = 64
+
+# short or full object id, compiled once for every object_resolve call
+HASH_RE = re.compile(r"^[0-9A-Fa-f]{4,40}$")
+
+# how many non-blob objects each repo keeps in its object_read cache
+OBJECT_CACHE_SIZE = 4096
+
+# trees smaller than this (about 50k entries at typical path lengths)
+# parse faster than numba can be loaded
+TREE_JIT_MIN_SIZE = 1 << 21
+# smallest tree record the scan accepts: 5 byte mode, space, empty path, nul and the sha
+TREE_RECORD_MIN_SIZE = 27
+
+# blobs at least this large are mmapped instead of read into memory
+MMAP_THRESHOLD = 1 << 20
+# size of the slices fed to the compressor when writing objects
+WRITE_CHUNK_SIZE = 1 << 20
+
 class GitObject(object):
     """ Baseclass for all git objects
     """
@@ -27,21 +65,79 @@ class GitObject(object):
 
 def object_read(repo : GitRepository, sha : str):
     """ Read an object_id from Git repo Return a GitObject whose 
-    exact type depends on the object
+    exact type depends on the object.
+    Commits, trees and tags are kept in a per-repo LRU, so repeated reads
+    return the same instance, callers must not modify it.
+    """
+    cache = repo._object_cache
+    obj = cache.get(sha)
+    if obj is not None:
+        cache.move_to_end(sha)
+        return obj
+
+    obj = _object_read(repo, sha)
+
+    # objects are immutable, but blobs can be huge so don't keep them around
+    if obj.fmt != b'blob':
+        cache[sha] = obj
+        if len(cache) > OBJECT_CACHE_SIZE:
+            cache.popitem(last=False)
+    return obj
+
+def _object_read(repo : GitRepository, sha : str):
+    """ Read and parse an object from disk, bypassing the cache
     """
-
     path = repo_file(repo, "objects", sha[0:2], sha[2:])
     with open(path, "rb") as f:
-        raw = zlib.decompress(f.read())
-
-        # Read object type, note the format will always be [type] followed by an ascii 'space'
-        x = raw.find(b' ')
-        fmt = raw[0:x]
-
-        y = raw.find(b"\x00", x)
-        size = int(raw[x:y].decode("ascii"))
-        if size != len(raw)-y-1 :
+        # inflate as we read instead of holding the whole compressed file too
+        d = _zlib.decompressobj()
+        head = b''
+        chunks = list()
+        produced = 0
+        # type and payload length, known as soon as the header has been inflated
+        fmt = None
+        while fmt is None or produced < size:
+            # input left over from a max_length-bounded call comes first,
+            # at end of file an empty call still drains output zlib held back
+            data = d.unconsumed_tail or f.read(READ_CHUNK_SIZE)
+
+            if fmt is None:
+                # bound the header too, so a bogus stream can't inflate a huge chunk,
+                # anything past the declared size is caught by the end of stream check
+                out = d.decompress(data, MAX_HEADER_SIZE - len(head))
+                head += out
+                y = head.find(b"\x00")
+                if y >= 0:
+                    # Read object type, note the format will always be [type] followed by an ascii 'space'
+                    x = head.find(b' ')
+                    fmt = head[0:x]
+                    size = int(head[x:y].decode("ascii"))
+                    # drop the header now, so the payload is not copied again after the join
+                    chunks.append(head[y+1:])
+                    produced = len(chunks[0])
+                elif len(head) >= MAX_HEADER_SIZE:
+                    break
+            else:
+                # never inflate past the declared size
+                out = d.decompress(data, size - produced)
+                chunks.append(out)
+                produced += len(out)
+
+            if not data and not out:
+                break
+
+        if fmt is None:
+            raise Exception(f"Malformed object {sha}: missing header")
+        raw = b''.join(chunks)
+        if size != len(raw):
             raise Exception(f"Malformed object {sha}: bad length")
+
+        # the stream must end right after the payload, inflating a single
+        # extra byte is enough to reject a longer one
+        while not d.eof:
+            data = d.unconsumed_tail or f.read(READ_CHUNK_SIZE)
+            if not data or d.decompress(data, 1):
+                raise Exception(f"Malformed object {sha}: bad length")
         
         #pick construtor
         if   fmt==b'commit' : cls=GitCommit
@@ -51,7 +147,7 @@ def object_read(repo : GitRepository, sha : str):
         else:
             raise Exception(f"Unknown type {fmt.decode('ascii')} for object {sha}")
     
-        return cls(repo, raw[y+1:])
+        return cls(repo, raw)
 
 def object_find(repo, name, fmt=None, follow=True):
     """ name resolution function since we can reference by full hash, short hash, tags...
@@ -86,8 +182,6 @@ def object_find(repo, name, fmt=None, follow=True):
 
 def object_resolve(repo, name):
     candidates = list()
-    hashRE = re.compile(r"^[0-9A-Fa-f]{1,16}$")
-    smallHashRE = re.compile(r"^[0-9A-Fa-f]{1,16}$")
 
     if not name.strip():
         return None
@@ -95,18 +189,18 @@ def object_resolve(repo, name):
     if name == "HEAD":
         return [ref_resolve(repo, "HEAD")]
     
-    if hashRE.match(name):
+    if HASH_RE.match(name):
         if len(name) == 40:
             return [name.lower()] # complete hash
-        elif len(name) >= 4:
-            name = name.lower()
-            prefix = name[0:2]
-            path = repo_dir(repo, "objects", prefix, mkdir=False)
-            if path:
-                rem = name[2:]
-                for f in os.listdir(path):
-                    if f.startswith(rem):
-                        candidates.append(prefix + f)
+        name = name.lower()
+        prefix = name[0:2]
+        path = repo_dir(repo, "objects", prefix, mkdir=False)
+        if path:
+            rem = name[2:]
+            with os.scandir(path) as it:
+                for f in it:
+                    if f.name.startswith(rem):
+                        candidates.append(prefix + f.name)
     return candidates
 
 
@@ -114,17 +208,50 @@ def object_write(obj, actually_write=True):
     """ Compute insert header, compute hash,  
     """
     data = obj.serialize()
-    result = obj.fmt + b" " + str(len(data)).encode() + b"\x00" + data
-    sha = hashlib.sha1(result).hexdigest()
+    header = obj.fmt + b" " + str(len(data)).encode() + b"\x00"
+
+    # hash header and data separately so data is never copied into a new buffer,
+    # hashlib.new goes to OpenSSL's sha1 (SHA-NI / ARMv8 crypto) when it is built in
+    h = hashlib.new("sha1")
+    h.update(header)
+    with memoryview(data) as view:
+        h.update(view)
+    sha = h.hexdigest()
 
     if actually_write:
         path=repo_file(obj.repo, "objects", sha[0:2], sha[2:], mkdir=actually_write)
 
-        with open(path, 'wb') as f:
-            f.write(zlib.compress(result))
+        # objects are content addressed, if it exists it is already correct
+        if os.path.exists(path):
+            return sha
+
+        # write to a temp file and rename, so readers never see a partial object.
+        # it lives in objects/ itself so object_resolve's prefix scan never sees it,
+        # thread id too, object_write_many can write the same object twice at once
+        tmp = repo_path(obj.repo, "objects", f"tmp_{sha}.{os.getpid()}.{threading.get_ident()}")
+        try:
+            with open(tmp, 'wb') as f, memoryview(data) as view:
+                z = _zlib.compressobj(COMPRESSION_LEVEL)
+                f.write(z.compress(header))
+                for i in range(0, len(view), WRITE_CHUNK_SIZE):
+                    f.write(z.compress(view[i:i+WRITE_CHUNK_SIZE]))
+                f.write(z.flush())
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
     
     return sha
 
+def object_write_many(objs, actually_write=True, max_workers=None):
+    """ object_write every object in objs on a thread pool, returning the shas
+        in the same order. zlib and hashlib release the GIL on large buffers,
+        so compressing and hashing many blobs scales with the number of cores
+    """
+    with ThreadPoolExecutor(max_workers or os.cpu_count()) as ex:
+        return list(ex.map(lambda o: object_write(o, actually_write), objs))
+
 class GitBlob(GitObject):
     fmt=b'blob'
 
@@ -135,6 +262,11 @@ class GitBlob(GitObject):
         self.blob_data = data
 
 def object_hash(fd, fmt, repo=None):
+    # map large blobs rather than reading them, object_write only needs a buffer
+    if fmt==b'blob' and os.fstat(fd.fileno()).st_size >= MMAP_THRESHOLD:
+        with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return object_write(GitBlob(repo, mm), repo)
+
     data = fd.read()
 
     # Choose constructor depending on
@@ -153,53 +285,52 @@ def object_hash(fd, fmt, repo=None):
 def kvlm_parse(raw, start : int=0, dct=None):
     
 
-    # use an ordered dict becuase in serialization it matters
-    if not dct:
-        dct = collections.OrderedDict()
+    # plain dicts keep insertion order, which serialization relies on
+    if dct is None:
+        dct = {}
 
-    # search for next space and next new line
-    spc = raw.find(b' ', start)
-    nl = raw.find(b'\n', start)
-    
-    # base case
-    # if newline appears first, we assume blankline
-    # blank line means remainder of data is message
+    # headers end at the first blank line, remainder of data is message
     # in example, this would be dct[b''] => Create first draft
-    if (spc < 0) or (nl < spc):
-        assert(nl == start)
-        dct[b''] = raw[start+1:]
-        return dct
-    
-    # recurse
-    # read key val pair, and recurse for next
-    key = raw[start:spc]
-
-    # Find the end of the value.  Continuation lines begin with a
-    # space, so we loop until we find a "\n" not followed by a space.
-    end = start
-    while True:
-        end = raw.find(b'\n', end+1)
-        if raw[end+1] != ord(' '): break
-
-    # Grab the value and drop the leading space on continuation lines
-    value = raw[spc+1:end].replace(b'\n ', b'\n')
-
-    # Don't overwrite existing data contents
-    # if the key exists, then we turn it into a list,
-    #    if it isn't already a list, turn it into one
-    if key in dct:
-        if type(dct[key]) == list:
-            dct[key].append(value)
-        else:
-            dct[key] = [ dct[key], value ]
+    if raw[start:start+1] == b'\n':
+        header_end = start
+        message_start = start + 1
     else:
-        dct[key]=value
-    
-    return kvlm_parse(raw, start=end+1, dct=dct)
+        header_end = raw.find(b'\n\n', start)
+        assert(header_end >= 0)
+        message_start = header_end + 2
+
+    # split the headers once, continuation lines begin with a space
+    # and get glued back onto the value of the field before them
+    fields = list()
+    if header_end > start:
+        for line in raw[start:header_end].split(b'\n'):
+            if line[:1] == b' ':
+                fields[-1][1].append(line[1:])
+            else:
+                key, _, value = line.partition(b' ')
+                fields.append((key, [value]))
+
+    for key, lines in fields:
+        value = b'\n'.join(lines)
+
+        # Don't overwrite existing data contents
+        # if the key exists, then we turn it into a list,
+        #    if it isn't already a list, turn it into one
+        old = dct.get(key)
+        if old is None:
+            dct[key]=value
+        elif isinstance(old, list):
+            old.append(value)
+        else:
+            dct[key] = [ old, value ]
+
+    dct[b''] = raw[message_start:]
+    return dct
 
 def kvlm_serialize(kvlm: dict):
     # Serialize to string in the same order 
-    ret = b''
+    # collect the pieces and join once at the end
+    parts = list()
 
     # Output fields
     for k in kvlm.keys():
@@ -207,15 +338,19 @@ def kvlm_serialize(kvlm: dict):
         if k == b'': continue
         val = kvlm[k]
         # Normalize to list
-        if type(val) != list:
+        if not isinstance(val, list):
             val = [val]
         
         for v in val:
-            ret += k + b' ' + (v.replace(b'\n', b'\n ')) + b'\n'
+            parts.append(k)
+            parts.append(b' ')
+            parts.append(v.replace(b'\n', b'\n '))
+            parts.append(b'\n')
     
-    ret += b'\n' + kvlm[b'']
+    parts.append(b'\n')
+    parts.append(kvlm[b''])
 
-    return ret
+    return b''.join(parts)
 
 class GitCommit(GitObject):
     fmt = b'commit'
@@ -226,55 +361,106 @@ class GitCommit(GitObject):
         return kvlm_serialize(self.kvlm)
 
 class GitTreeLeaf(object):
+    # trees can hold thousands of entries, skip the per-instance __dict__
+    __slots__ = ("mode", "path", "sha")
+
     def __init__(self, mode, path, sha):
         self.mode = mode
         self.path = path
         self.sha = sha
     
 
-def tree_parse_one(raw, start=0):
-    """ Create a parser that extracts a single record and returns the parsed data
-        along with where it leaves off
+def _tree_scan_records(buf):
+    """ Return the (space, nul) offsets of every record in buf, a uint8 array
     """
-    # Find the space terminator
-    x = raw.find(b' ', start)
-    assert(x-start == 5 or x-start==6)
-
-    mode = raw[start:x]
-
-    # get path
-    y = raw.find(b'\x00', x)
-    path = raw[x+1:y]
-
-    # read sha and convert into hex string
-    sha = hex(
-        int.from_bytes(
-            raw[y+1:y+21], "big"
-        )
-    )[2:] # hex adds 0x in front
-
-    return y+21, GitTreeLeaf(mode, path, sha)
+    n = len(buf)
+    ret = numpy.empty((n // TREE_RECORD_MIN_SIZE + 1, 2), numpy.int64)
+    count = 0
+    pos = 0
+    while pos < n:
+        x = pos
+        while x < n and buf[x] != 0x20:
+            x += 1
+        if x == n:
+            raise ValueError("Malformed tree record")
+        assert(x-pos == 5 or x-pos == 6)
+        y = x
+        while y < n and buf[y] != 0:
+            y += 1
+        if y == n:
+            raise ValueError("Malformed tree record")
+        # numba doesn't bounds check, never write past the end of ret
+        if count == len(ret):
+            raise ValueError("Malformed tree record")
+        ret[count, 0] = x
+        ret[count, 1] = y
+        count += 1
+        pos = y+21
+    return ret[:count]
+
+# _tree_scan_records compiled by numba, set by _load_tree_scan
+_tree_scan = None
+
+def _load_tree_scan():
+    """ Import numba and compile the record scan, returns None if that fails
+    """
+    global _HAVE_NUMBA, _tree_scan, numpy
+    try:
+        import numba
+        import numpy
+    except ImportError:
+        _HAVE_NUMBA = False
+        return None
+    _tree_scan = numba.njit(cache=True)(_tree_scan_records)
+    return _tree_scan
 
 def tree_parse(raw):
-    pos = 0
-    max = len(raw)
+    """ Parse every record in a single pass: locate the separators with
+        bytes.index (or the numba scan), and hexify all the shas with one
+        binascii call at the end
+    """
+    entries = list()
+    shas = list()
+    scan = None
+    if _HAVE_NUMBA and len(raw) >= TREE_JIT_MIN_SIZE:
+        scan = _tree_scan or _load_tree_scan()
+
+    if scan is not None:
+        pos = 0
+        for x, y in scan(numpy.frombuffer(raw, numpy.uint8)).tolist():
+            entries.append((raw[pos:x], raw[x+1:y]))
+            shas.append(raw[y+1:y+21])
+            pos = y+21
+    else:
+        index = raw.index
+        pos = 0
+        max = len(raw)
+        while pos < max:
+            x = index(b' ', pos)
+            assert(x-pos == 5 or x-pos==6)
+            y = index(b'\x00', x)
+            entries.append((raw[pos:x], raw[x+1:y]))
+            shas.append(raw[y+1:y+21])
+            pos = y+21
+
+    # 40 hex characters per sha
+    hexed = binascii.hexlify(b''.join(shas)).decode("ascii")
     ret = list()
-    while pos < max:
-        pos, data = tree_parse_one(raw, pos)
-        ret.append(data)
+    for i, (mode, path) in enumerate(entries):
+        ret.append(GitTreeLeaf(mode, path, hexed[i*40:i*40+40]))
     
     return ret
 
 def tree_serialize(obj):
-    ret = b''
+    # bytearray grows in place, unlike repeated bytes concatenation
+    ret = bytearray()
     for i in obj.items:
         ret += i.mode
         ret += b' '
         ret += i.path
         ret += b'\x00'
-        sha = int(i.sha, 16)
-        ret += sha.to_bytes(20, byteorder="big")
-    return ret
+        ret += binascii.unhexlify(i.sha)
+    return bytes(ret)
 
 class GitTree(GitObject):
     fmt = b'tree'
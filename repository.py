@@ -4,11 +4,15 @@ import configparser
 import hashlib
 import os
 import re
+import stat
 import sys
 import zlib
 import pathlib
 from typing import Optional
 
+# how many refs ref_resolve reads before assuming a symref loop, same as git
+SYMREF_MAXDEPTH = 5
+
 class GitRepository(object):
     """ Git repository abstraction
     """
@@ -21,6 +25,12 @@ class GitRepository(object):
         """
         self.worktree = path
         self.gitdir = os.path.join(path, ".vcsync")
+        # repo_path builds object paths on top of this without os.path.join
+        self._gitdir_prefix = self.gitdir + os.sep
+        # parent dirs repo_file already found, so we can skip the stat calls
+        self._dir_cache = set()
+        # recently read objects, see obj.object_read
+        self._object_cache = collections.OrderedDict()
         
         if not (force or os.path.isdir(self.gitdir)):
             raise Exception(f"Not a Git repository {path}")
@@ -42,6 +52,9 @@ class GitRepository(object):
 def repo_path(repo : GitRepository, *path) -> Optional[str]:
     """ Compute path under repo's gitdir
     """
+    # objects/xx/yy is by far the most common shape, build it directly
+    if len(path) == 3 and path[0] == "objects":
+        return f"{repo._gitdir_prefix}objects{os.sep}{path[1]}{os.sep}{path[2]}"
     return os.path.join(repo.gitdir, *path)
 
 def repo_dir(repo : GitRepository, *path, mkdir: bool = False) -> Optional[str]:
@@ -49,22 +62,32 @@ def repo_dir(repo : GitRepository, *path, mkdir: bool = False) -> Optional[str]:
     """
     path = repo_path(repo, *path)
 
-    if os.path.exists(path):
-        if os.path.isdir(path):
+    # one stat instead of exists + isdir, a file in the middle of
+    # the path means it doesn't exist, same as os.path.exists
+    try:
+        st = os.stat(path)
+    except (FileNotFoundError, NotADirectoryError):
+        if mkdir:
+            # another thread may create it between the check and here
+            os.makedirs(path, exist_ok=True)
             return path
         else:
-            raise Exception(f"Not a directory {path}")
-    
-    if mkdir:
-        os.makedirs(path)
+            return None
+
+    if stat.S_ISDIR(st.st_mode):
         return path
     else:
-        return None
+        raise Exception(f"Not a directory {path}")
     
 def repo_file(repo : GitRepository, *path, mkdir : bool = False) -> Optional[str]:
     """ Same as repo_path, but will create dirname(path) if absent
     """
-    if repo_dir(repo, *path[:-1], mkdir=mkdir):
+    parent = path[:-1]
+    if parent in repo._dir_cache:
+        return repo_path(repo, *path)
+
+    if repo_dir(repo, *parent, mkdir=mkdir):
+        repo._dir_cache.add(parent)
         return repo_path(repo, *path)
 
 def repo_create(path : str):
@@ -115,42 +138,49 @@ def repo_find(path : str = ".", required : bool = True):
     """
     path = os.path.realpath(path)
 
-    if os.path.isdir(os.path.join(path, ".vcsync")):
-        return GitRepository(path)
-    
-    # If not found, recurse through parents
-    parent = os.path.realpath(os.path.join(path, ".."))
+    # walk up through parents until we find the git dir
+    while not os.path.isdir(os.path.join(path, ".vcsync")):
+        parent = os.path.realpath(os.path.join(path, ".."))
 
-    # handle base case, at root:
-    if parent == path:
-        if required:
-            raise Exception("No git directory")
-        else:
-            return None
-    
-    # Recurse
-    return repo_find(parent, required)
+        # handle base case, at root:
+        if parent == path:
+            if required:
+                raise Exception("No git directory")
+            else:
+                return None
+
+        path = parent
+
+    return GitRepository(path)
 
 
 def ref_resolve(repo, ref):
-    with open(repo_file(repo, ref), 'r') as fp:
-        data = fp.read()[:-1] # drop final \n
-    
-    if data.startswith("ref: "):
-        return ref_resolve(repo, data[5:])
-    else:
-        return data
+    # follow symbolic refs until we reach a sha, giving up after as many as git does
+    for _ in range(SYMREF_MAXDEPTH):
+        with open(repo_file(repo, ref), 'r') as fp:
+            data = fp.read()[:-1] # drop final \n
+
+        if not data.startswith("ref: "):
+            return data
+        ref = data[5:]
+    raise Exception(f"Symbolic ref loop at {ref}")
 
 def ref_list(repo, path=None):
     if not path:
         path = repo_dir(repo, "refs")
-    ret = collections.OrderedDict()
-
-    for f in sorted(os.listdir(path)):
-        can = os.path.join(path, f)
-        print(can)
-        if os.path.isdir(can):
-            ref = ref_list(repo, can)
-        else:
-            ret[f] = ref_resolve(repo, can)
+    ret = {}
+
+    # explicit stack of (directory, dict to fill) instead of recursing
+    stack = [(path, ret)]
+    while stack:
+        path, dct = stack.pop()
+        # scandir gets the file type from the listing, no stat per ref
+        with os.scandir(path) as it:
+            entries = sorted(it, key=lambda e: e.name)
+        for e in entries:
+            if e.is_dir():
+                dct[e.name] = {}
+                stack.append((e.path, dct[e.name]))
+            else:
+                dct[e.name] = ref_resolve(repo, e.path)
     return ret
\ No newline at end of file
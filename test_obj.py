@@ -0,0 +1,49 @@
+import unittest
+from unittest import mock
+
+import obj
+
+# 5 byte mode, empty path: the smallest record tree_parse accepts
+SMALL_RECORD = b'40000 \x00' + b'\x01' * 20
+
+
+def leaves(items):
+    return [(i.mode, i.path, i.sha) for i in items]
+
+
+class TreeParseTest(unittest.TestCase):
+
+    def test_empty_path_records(self):
+        raw = SMALL_RECORD * 3
+        items = obj.tree_parse(raw)
+        self.assertEqual(leaves(items), [(b'40000', b'', '01' * 20)] * 3)
+
+    @unittest.skipUnless(obj._HAVE_NUMBA, "numba is not installed")
+    def test_large_tree_with_numba(self):
+        # enough records to take the numba path, all of them minimum size
+        count = obj.TREE_JIT_MIN_SIZE // len(SMALL_RECORD) + 1000
+        raw = SMALL_RECORD * count
+        self.assertGreaterEqual(len(raw), obj.TREE_JIT_MIN_SIZE)
+
+        items = obj.tree_parse(raw)
+        self.assertIsNotNone(obj._tree_scan)
+
+        with mock.patch.object(obj, "TREE_JIT_MIN_SIZE", len(raw) + 1):
+            expected = obj.tree_parse(raw)
+        self.assertEqual(leaves(items), leaves(expected))
+        self.assertEqual(len(items), count)
+
+    @unittest.skipUnless(obj._HAVE_NUMBA, "numba is not installed")
+    def test_large_tree_with_numba_mixed_modes(self):
+        records = (b'100644 file\x00' + b'\x02' * 20, SMALL_RECORD)
+        count = obj.TREE_JIT_MIN_SIZE // len(SMALL_RECORD)
+        raw = b''.join(records[i % 2] for i in range(count))
+
+        items = obj.tree_parse(raw)
+        with mock.patch.object(obj, "TREE_JIT_MIN_SIZE", len(raw) + 1):
+            expected = obj.tree_parse(raw)
+        self.assertEqual(leaves(items), leaves(expected))
+
+
+if __name__ == "__main__":
+    unittest.main()
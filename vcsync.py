@@ -97,7 +97,7 @@ def log_graphviz(repo, sha, seen):
 
     parents = commit.kvlm[b'parent']
 
-    if type(parents) != list:
+    if not isinstance(parents, list):
         parents = [ parents ]
 
     for p in parents:
@@ -167,7 +167,7 @@ def cmd_show_ref(args):
 
 def show_ref(repo, refs, with_hash=True, prefix=""):
     for k,v in refs.items():
-        if type(v) == str:
+        if isinstance(v, str):
             print ("{0}{1}{2}".format(
                 v + " " if with_hash else "",
                 prefix + os.sep if prefix else "",
@@ -200,7 +200,7 @@ def tag_create(repo, name, reference, type):
     if type=="object":
         # create tag object (commit)
         tag = GitTag(repo)
-        tag.kvlm = collections.OrderedDict()
+        tag.kvlm = {}
         tag.kvlm[b'object'] = sha.encode()
         tag.kvlm[b'type'] = b'commit'
         tag.kvlm[b'tag'] = name.encode()